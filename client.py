@@ -1,11 +1,73 @@
+import ctypes
+import os
+import selectors
 import socket
+import struct
 import time
-import random
-import threading
-import requests
-import socks  # Add this import
 from typing import Optional
-from config import TestConfig, ProxyConfig, parse_client_args
+from config import TCP_HELLO, TCP_HELLO_MAGIC, TestConfig, ProxyConfig, parse_client_args
+import mmsg
+
+_SEQ = struct.Struct('>Q')  # Big-endian sequence number header
+STATS_CHECK_PACKETS = 1024  # Packets sent between clock reads in the unpaced batch loop
+STATS_CHECK_NS = 10_000_000  # ...as long as that many packets take less than this to send
+
+# SOCKS5 reply codes from RFC 1928
+_SOCKS5_ERRORS = {
+    0x01: "general SOCKS server failure",
+    0x02: "connection not allowed by ruleset",
+    0x03: "network unreachable",
+    0x04: "host unreachable",
+    0x05: "connection refused",
+    0x06: "TTL expired",
+    0x07: "command not supported",
+    0x08: "address type not supported",
+}
+
+def _recv_exact(sock, size):
+    """Receive exactly size bytes from a stream socket"""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("SOCKS5 proxy closed the connection")
+        data += chunk
+    return data
+
+def _socks5_connect(sock, host, port, username=None, password=None):
+    """Ask the SOCKS5 proxy sock is connected to for a connection to host:port (RFC 1928/1929)"""
+    methods = b'\x00\x02' if username is not None else b'\x00'
+    sock.sendall(b'\x05' + bytes([len(methods)]) + methods)
+    version, method = _recv_exact(sock, 2)
+    if version != 5:
+        raise ConnectionError("Proxy is not a SOCKS5 server")
+    if method == 0x02:
+        user = username.encode()
+        secret = (password or '').encode()
+        sock.sendall(b'\x01' + bytes([len(user)]) + user + bytes([len(secret)]) + secret)
+        if _recv_exact(sock, 2)[1] != 0:
+            raise ConnectionError("SOCKS5 authentication failed")
+    elif method != 0x00:
+        raise ConnectionError("SOCKS5 proxy rejected the offered authentication methods")
+
+    # IPv4 addresses are sent as such, host names are resolved by the proxy
+    try:
+        address = b'\x01' + socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        name = host.encode('idna')
+        address = b'\x03' + bytes([len(name)]) + name
+    sock.sendall(b'\x05\x01\x00' + address + struct.pack('>H', port))
+
+    _, reply, _, address_type = _recv_exact(sock, 4)
+    if reply != 0:
+        raise ConnectionError(f"SOCKS5 connect failed: {_SOCKS5_ERRORS.get(reply, f'error {reply}')}")
+    # Skip the bound address and port, the stream after them belongs to the test
+    if address_type == 0x01:
+        _recv_exact(sock, 4 + 2)
+    elif address_type == 0x04:
+        _recv_exact(sock, 16 + 2)
+    else:
+        _recv_exact(sock, _recv_exact(sock, 1)[0] + 2)
 
 class PacketClient:
     def __init__(self, config: TestConfig, proxy_config: Optional[ProxyConfig] = None):
@@ -15,27 +77,30 @@ class PacketClient:
         self.running = False
         self.sent_packets = 0
         self.received_acks = 0
-        self.start_time = None
-        self.last_stats_time = None
+        self.start_ns = None  # time.monotonic_ns() at test start
         self.stats_interval = 1.0  # Print stats every second
         self.sequence_number = 0
-        self.lock = threading.Lock()  # For thread-safe stats updates
+        self._msgs = None  # sendmmsg message vector, set up for UDP on Linux
+        self._send_one = None  # Per-protocol single packet send, built in setup_socket
+        self._sel = None  # Waits for send buffer space when sendmmsg would block
+        self._tokens = 0.0  # Token bucket for --rate pacing
+        self._last_refill_ns = 0
+
+        # Payload content is irrelevant for a loss test, so it is generated once and reused.
+        # Only the 8-byte sequence header in front of it changes between packets.
+        self._packet_buf = bytearray(8 + config.message_size)
+        self._packet_buf[8:] = os.urandom(config.message_size)
+        self._ack_buf = bytearray(8)  # Acknowledgments are received into this buffer
+        self._ack_len = 0  # Bytes of a TCP acknowledgment reassembled so far
 
     def setup_socket(self):
         """Set up the socket based on protocol and proxy settings"""
         if self.proxy_config:
             if self.config.protocol == "tcp":
-                # For TCP with proxy, use socks.socksocket
-                self.verify_proxy()  # Verify proxy first
-                self.sock = socks.socksocket()
-                self.sock.set_proxy(
-                    proxy_type=socks.SOCKS5,
-                    addr=self.proxy_config.host,
-                    port=self.proxy_config.port,
-                    username=self.proxy_config.username,
-                    password=self.proxy_config.password,
-                    rdns=True
-                )
+                # For TCP with proxy, the SOCKS5 handshake happens in connect()
+                if self.proxy_config.verify:
+                    self.verify_proxy()  # Verify proxy first
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 print(f"Socket configured to use SOCKS5 proxy: {self.proxy_config.host}:{self.proxy_config.port}")
             else:
                 raise ValueError("SOCKS5 proxies only support TCP connections")
@@ -45,30 +110,75 @@ class PacketClient:
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             else:  # UDP
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                if mmsg.available:
+                    self.setup_batch()
+
+        # Large buffers absorb bursts instead of turning them into local drops
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.config.sndbuf)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.config.rcvbuf)
+        if self.config.protocol == "tcp":
+            # Don't let Nagle's algorithm hold back small packets
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         self.sock.settimeout(1.0)  # 1 second timeout for operations
 
+        if self.config.protocol == "tcp":
+            self._send_one = self._make_send_one_tcp()
+        else:
+            self._send_one = self._make_send_one_udp()
+
+    def setup_batch(self):
+        """Preallocate the sendmmsg message vector used for batched UDP sends"""
+        batch = mmsg.BATCH_SIZE
+        # Sequence headers form a ring in one pinned pool; every message shares the
+        # payload stored behind the single-packet header in _packet_buf
+        self._hdr_pool = bytearray(8 * batch)
+        hdr_base = ctypes.addressof(ctypes.c_char.from_buffer(self._hdr_pool))
+        payload = (ctypes.c_char * self.config.message_size).from_buffer(self._packet_buf, 8)
+        payload_base = ctypes.addressof(payload)
+        self._iov = (mmsg.IOVec * (2 * batch))()
+        self._msgs = (mmsg.MMsgHdr * batch)()
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self.sock, selectors.EVENT_WRITE)
+
+        iov_base = ctypes.addressof(self._iov)
+        for i in range(batch):
+            self._iov[2 * i].iov_base = hdr_base + 8 * i
+            self._iov[2 * i].iov_len = 8
+            self._iov[2 * i + 1].iov_base = payload_base
+            self._iov[2 * i + 1].iov_len = self.config.message_size
+            # msg_name stays NULL, the socket is connected to the server
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_iov = iov_base + 2 * i * ctypes.sizeof(mmsg.IOVec)
+            hdr.msg_iovlen = 2
+
+    def connect_through_proxy(self, sock):
+        """Connect sock to the server through the configured SOCKS5 proxy"""
+        sock.connect((self.proxy_config.host, self.proxy_config.port))
+        _socks5_connect(
+            sock,
+            self.config.host,
+            self.config.port,
+            username=self.proxy_config.username,
+            password=self.proxy_config.password
+        )
+
     def verify_proxy(self):
-        """Verify proxy connection by making a test request"""
+        """Verify proxy connection by completing a SOCKS5 handshake to the server"""
         if not self.proxy_config:
             return
 
-        proxies = {
-            'http': f'socks5://{self.proxy_config.host}:{self.proxy_config.port}',
-            'https': f'socks5://{self.proxy_config.host}:{self.proxy_config.port}'
-        }
-
-        if self.proxy_config.username and self.proxy_config.password:
-            proxies['http'] = f'socks5://{self.proxy_config.username}:{self.proxy_config.password}@{self.proxy_config.host}:{self.proxy_config.port}'
-            proxies['https'] = f'socks5://{self.proxy_config.username}:{self.proxy_config.password}@{self.proxy_config.host}:{self.proxy_config.port}'
-
         try:
             print("Verifying proxy connection...")
             print("Note: TCP connection will be verified, but UDP support is not guaranteed")
-            response = requests.get('http://checkip.amazonaws.com', proxies=proxies, timeout=10)
-            response.raise_for_status()
-            print(f"Proxy connection successful! Current IP: {response.text.strip()}")
-        except requests.exceptions.RequestException as e:
+            probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            probe.settimeout(10)
+            try:
+                self.connect_through_proxy(probe)
+            finally:
+                probe.close()
+            print("Proxy connection successful!")
+        except OSError as e:
             raise ConnectionError(f"Failed to connect through proxy: {e}")
 
     def connect(self):
@@ -76,58 +186,153 @@ class PacketClient:
         try:
             if self.proxy_config:
                 if self.config.protocol == "tcp":
-                    # For TCP with proxy, the proxy is already configured in the socket
-                    self.sock.connect((self.config.host, self.config.port))
+                    self.connect_through_proxy(self.sock)
                     print(f"Connected to {self.config.host}:{self.config.port} through SOCKS5 proxy")
                 else:
                     raise ValueError("SOCKS5 proxies only support TCP connections")
             else:
+                # For UDP, connecting fixes the destination so sends skip per-packet address handling
+                self.sock.connect((self.config.host, self.config.port))
                 if self.config.protocol == "tcp":
-                    self.sock.connect((self.config.host, self.config.port))
                     print(f"Connected to {self.config.host}:{self.config.port}")
-                # For UDP, no explicit connect needed
+            if self.config.protocol == "tcp":
+                self.sock.sendall(TCP_HELLO.pack(TCP_HELLO_MAGIC, self.config.message_size))
         except Exception as e:
             raise ConnectionError(f"Failed to connect to server: {e}")
 
-    def send_packet(self):
-        """Send a single packet and wait for acknowledgment"""
+    def recv_tcp_ack(self):
+        """Read the next 8-byte acknowledgment from the TCP stream, resuming after short reads"""
+        view = memoryview(self._ack_buf)
+        while self._ack_len < 8:
+            n = self.sock.recv_into(view[self._ack_len:])
+            if not n:
+                raise ConnectionError("Server closed the connection")
+            self._ack_len += n
+        self._ack_len = 0
+        return _SEQ.unpack_from(self._ack_buf)[0]
+
+    def _make_send_one_tcp(self):
+        """Build the TCP single packet send, which returns 1 if the packet was acknowledged
+
+        Everything it touches per packet is resolved here once and kept as closure locals.
+        """
+        sendall = self.sock.sendall
+        recv_tcp_ack = self.recv_tcp_ack
+        pack = _SEQ.pack_into
+        buf = self._packet_buf
+
+        def send_one():
+            seq = self.sequence_number
+            # Write the sequence number (8 bytes) in front of the preallocated payload
+            pack(buf, 0, seq)
+            sendall(buf)
+            acked = 0
+            try:
+                # Skip late acknowledgments for packets that already timed out
+                ack_num = recv_tcp_ack()
+                while ack_num < seq:
+                    ack_num = recv_tcp_ack()
+                if ack_num == seq:
+                    acked = 1
+            except socket.timeout:
+                pass  # No acknowledgment received
+            self.received_acks += acked
+            self.sent_packets += 1
+            self.sequence_number = seq + 1
+            return acked
+        return send_one
+
+    def _make_send_one_udp(self):
+        """Build the UDP single packet send, which returns 1 if the packet was acknowledged
+
+        Everything it touches per packet is resolved here once and kept as closure locals.
+        """
+        send = self.sock.send
+        recv_into = self.sock.recv_into
+        pack = _SEQ.pack_into
+        unpack = _SEQ.unpack_from
+        buf = self._packet_buf
+        ack_buf = self._ack_buf
+
+        def send_one():
+            seq = self.sequence_number
+            pack(buf, 0, seq)
+            send(buf)
+            acked = 0
+            try:
+                # Skip late acknowledgments for packets that already timed out
+                ack_num = -1
+                while ack_num < seq:
+                    if recv_into(ack_buf) == 8:
+                        ack_num = unpack(ack_buf)[0]
+                if ack_num == seq:
+                    acked = 1
+            except (socket.timeout, ConnectionRefusedError):
+                pass  # No acknowledgment received
+            self.received_acks += acked
+            self.sent_packets += 1
+            self.sequence_number = seq + 1
+            return acked
+        return send_one
+
+    def _send_batch(self, count=mmsg.BATCH_SIZE):
+        """Send the next count packets with one sendmmsg call and return how many were acknowledged"""
+        first_seq = self.sequence_number
+        last_seq = first_seq + count
+        pack = _SEQ.pack_into
+        hdr_pool = self._hdr_pool
+        for i in range(count):
+            pack(hdr_pool, 8 * i, first_seq + i)
+
+        fd = self.sock.fileno()
+        msg_size = ctypes.sizeof(mmsg.MMsgHdr)
+        sent = 0
+        while sent < count:
+            n = mmsg.sendmmsg(fd, ctypes.addressof(self._msgs) + sent * msg_size, count - sent, 0)
+            if n < 0:
+                err = mmsg.last_error()
+                if err.errno not in (socket.EAGAIN, socket.EWOULDBLOCK):
+                    raise err
+                # Send buffer is full, wait for it to drain
+                self._sel.select(self.config.timeout)
+                continue
+            sent += n
+
+        acked = 0
+        recv_into = self.sock.recv_into
+        unpack = _SEQ.unpack_from
+        ack_buf = self._ack_buf
         try:
-            # Generate random payload
-            payload = random.randbytes(self.config.message_size)
-            
-            # Create packet with sequence number (8 bytes) + payload
-            packet = self.sequence_number.to_bytes(8, byteorder='big') + payload
-            
-            if self.config.protocol == "tcp":
-                self.sock.send(packet)
-                try:
-                    ack = self.sock.recv(8)  # Receive 8-byte acknowledgment
-                    if len(ack) == 8:
-                        ack_num = int.from_bytes(ack, byteorder='big')
-                        if ack_num == self.sequence_number:
-                            with self.lock:
-                                self.received_acks += 1
-                except socket.timeout:
-                    pass  # No acknowledgment received
-            else:  # UDP
-                self.sock.sendto(packet, (self.config.host, self.config.port))
-                try:
-                    ack, _ = self.sock.recvfrom(8)  # Receive 8-byte acknowledgment
-                    if len(ack) == 8:
-                        ack_num = int.from_bytes(ack, byteorder='big')
-                        if ack_num == self.sequence_number:
-                            with self.lock:
-                                self.received_acks += 1
-                except socket.timeout:
-                    pass  # No acknowledgment received
-            
-            with self.lock:
-                self.sent_packets += 1
-                self.sequence_number += 1
-            
-        except Exception as e:
-            print(f"Error sending packet: {e}")
-            raise
+            # Late acknowledgments from earlier batches are skipped rather than taking up
+            # one of this batch's reads
+            while acked < count:
+                if recv_into(ack_buf) == 8 and first_seq <= unpack(ack_buf)[0] < last_seq:
+                    acked += 1
+        except (socket.timeout, ConnectionRefusedError):
+            pass  # Remaining acknowledgments are lost
+
+        self.received_acks += acked
+        self.sent_packets += count
+        self.sequence_number += count
+        return acked
+
+    def pace(self, count, end_ns):
+        """Block until the token bucket allows count more packets to be sent
+
+        Returns False instead if the test would end before then.
+        """
+        rate = self.config.rate
+        now = time.monotonic_ns()
+        # Refill, allowing at most one send call worth of burst
+        self._tokens = min(self._tokens + (now - self._last_refill_ns) * rate / 1e9, float(count))
+        self._last_refill_ns = now
+        self._tokens -= count
+        if self._tokens < 0:
+            wait_ns = -self._tokens / rate * 1e9
+            if now + wait_ns >= end_ns:
+                return False
+            time.sleep(wait_ns / 1e9)
+        return True
 
     def run(self):
         """Run the packet test"""
@@ -136,30 +341,64 @@ class PacketClient:
             self.connect()
             
             self.running = True
-            self.start_time = time.time()
-            self.last_stats_time = self.start_time
+            self.start_ns = time.monotonic_ns()
+            stats_interval_ns = int(self.stats_interval * 1e9)
+            stats_deadline_ns = self.start_ns + stats_interval_ns
             
             print(f"Starting {self.config.protocol.upper()} test to {self.config.host}:{self.config.port}")
             if self.proxy_config:
                 print(f"Using SOCKS5 proxy: {self.proxy_config.host}:{self.proxy_config.port}")
             print(f"Message size: {self.config.message_size} bytes")
             print(f"Test duration: {self.config.runtime} seconds")
+            if self.config.rate:
+                print(f"Rate limit: {self.config.rate} packets per second")
             print("Press Ctrl+C to stop the test")
             
-            end_time = self.start_time + self.config.runtime
+            end_ns = self.start_ns + int(self.config.runtime * 1e9)
+            self._last_refill_ns = self.start_ns
+            now_ns = self.start_ns
+            next_check = 0  # sent_packets value at which the clock is read next
+            last_check_ns = self.start_ns
             
-            while self.running and time.time() < end_time:
+            # Resolve what the loop touches per iteration once, as locals, and pick the send
+            # path up front so the loop itself never branches on protocol or batching
+            rate = self.config.rate
+            pace = self.pace
+            if self._msgs is not None:
+                send, count = self._send_batch, mmsg.BATCH_SIZE
+                if rate:
+                    # Keep each paced batch to about a millisecond of traffic, so low rates
+                    # go out as evenly spaced packets rather than full-batch bursts
+                    count = min(count, max(1, int(rate / 1000)))
+                    send = lambda: self._send_batch(count)
+            else:
+                send, count = self._send_one, 1
+            # A single packet waits a full round trip for its ack, which through a slow proxy
+            # can take longer than the whole test, so only unpaced batches skip clock reads
+            check_every = STATS_CHECK_PACKETS if self._msgs is not None and not rate else 0
+            
+            while self.running and now_ns < end_ns:
                 try:
-                    self.send_packet()
+                    if rate and not pace(count, end_ns):
+                        break
+                    acked = send()
+                    
+                    # Only read the clock every check_every packets, unless this iteration
+                    # may have blocked for a while on a missing acknowledgment
+                    if self.sent_packets < next_check and acked == count:
+                        continue
+                    now_ns = time.monotonic_ns()
+                    # Go back to reading the clock every iteration while packets are slow to go out
+                    if now_ns - last_check_ns < STATS_CHECK_NS:
+                        next_check = self.sent_packets + check_every
+                    else:
+                        next_check = 0
+                    last_check_ns = now_ns
                     
                     # Print periodic statistics
-                    current_time = time.time()
-                    if current_time - self.last_stats_time >= self.stats_interval:
+                    if now_ns >= stats_deadline_ns:
                         self.print_current_stats()
-                        self.last_stats_time = current_time
-                    
-                    # Small delay to prevent overwhelming the network
-                    time.sleep(0.001)
+                        stats_deadline_ns = now_ns + stats_interval_ns
                     
                 except KeyboardInterrupt:
                     print("\nTest interrupted by user")
@@ -180,6 +419,8 @@ class PacketClient:
     def cleanup(self):
         """Clean up resources"""
         try:
+            if self._sel:
+                self._sel.close()
             if self.sock:
                 self.sock.close()
         except Exception as e:
@@ -187,42 +428,40 @@ class PacketClient:
         self.print_final_stats()
 
     def print_current_stats(self):
-        if not self.start_time:
+        if self.start_ns is None:
             return
             
-        duration = time.time() - self.start_time
-        with self.lock:
-            packets_per_second = self.sent_packets / duration if duration > 0 else 0
-            ack_rate = (self.received_acks / self.sent_packets * 100) if self.sent_packets > 0 else 0
-            
-            print(f"\nCurrent Client Statistics:")
-            print(f"Protocol: {self.config.protocol.upper()}")
-            if self.proxy_config:
-                print(f"Using SOCKS5 proxy: {self.proxy_config.host}:{self.proxy_config.port}")
-            print(f"Packets sent: {self.sent_packets}")
-            print(f"Packets acknowledged: {self.received_acks}")
-            print(f"Acknowledgment rate: {ack_rate:.1f}%")
-            print(f"Running time: {duration:.1f} seconds")
-            print(f"Average packets per second: {packets_per_second:.1f}")
+        duration = (time.monotonic_ns() - self.start_ns) / 1e9
+        packets_per_second = self.sent_packets / duration if duration > 0 else 0
+        ack_rate = (self.received_acks / self.sent_packets * 100) if self.sent_packets > 0 else 0
+        
+        print(f"\nCurrent Client Statistics:")
+        print(f"Protocol: {self.config.protocol.upper()}")
+        if self.proxy_config:
+            print(f"Using SOCKS5 proxy: {self.proxy_config.host}:{self.proxy_config.port}")
+        print(f"Packets sent: {self.sent_packets}")
+        print(f"Packets acknowledged: {self.received_acks}")
+        print(f"Acknowledgment rate: {ack_rate:.1f}%")
+        print(f"Running time: {duration:.1f} seconds")
+        print(f"Average packets per second: {packets_per_second:.1f}")
 
     def print_final_stats(self):
-        if not self.start_time:
+        if self.start_ns is None:
             return
             
-        duration = time.time() - self.start_time
-        with self.lock:
-            packets_per_second = self.sent_packets / duration if duration > 0 else 0
-            ack_rate = (self.received_acks / self.sent_packets * 100) if self.sent_packets > 0 else 0
-            
-            print(f"\nFinal Client Statistics:")
-            print(f"Protocol: {self.config.protocol.upper()}")
-            if self.proxy_config:
-                print(f"Using SOCKS5 proxy: {self.proxy_config.host}:{self.proxy_config.port}")
-            print(f"Total packets sent: {self.sent_packets}")
-            print(f"Total packets acknowledged: {self.received_acks}")
-            print(f"Final acknowledgment rate: {ack_rate:.1f}%")
-            print(f"Total running time: {duration:.1f} seconds")
-            print(f"Average packets per second: {packets_per_second:.1f}")
+        duration = (time.monotonic_ns() - self.start_ns) / 1e9
+        packets_per_second = self.sent_packets / duration if duration > 0 else 0
+        ack_rate = (self.received_acks / self.sent_packets * 100) if self.sent_packets > 0 else 0
+        
+        print(f"\nFinal Client Statistics:")
+        print(f"Protocol: {self.config.protocol.upper()}")
+        if self.proxy_config:
+            print(f"Using SOCKS5 proxy: {self.proxy_config.host}:{self.proxy_config.port}")
+        print(f"Total packets sent: {self.sent_packets}")
+        print(f"Total packets acknowledged: {self.received_acks}")
+        print(f"Final acknowledgment rate: {ack_rate:.1f}%")
+        print(f"Total running time: {duration:.1f} seconds")
+        print(f"Average packets per second: {packets_per_second:.1f}")
 
 def main():
     config, proxy_config = parse_client_args()
@@ -1,13 +1,22 @@
 import argparse
+import os
+import socket
+import struct
 from typing import Optional, Literal
 from dataclasses import dataclass
 
+# Sent by the client at the start of every TCP connection: a magic/version tag followed by
+# the payload size of its packets, which the server uses to split the stream back into packets
+TCP_HELLO = struct.Struct('>4sI')
+TCP_HELLO_MAGIC = b'PLT1'
+
 @dataclass
 class ProxyConfig:
     host: str
     port: int
     username: Optional[str] = None
     password: Optional[str] = None
+    verify: bool = False  # Probe the proxy with a separate handshake before the test
 
 @dataclass
 class TestConfig:
@@ -18,6 +27,10 @@ class TestConfig:
     runtime: Optional[float] = None  # in seconds
     message_size: int = 1024  # bytes
     timeout: float = 1.0  # seconds
+    rate: Optional[float] = None  # packets per second, unlimited if not set
+    workers: int = 1  # server processes sharing the port via SO_REUSEPORT
+    sndbuf: int = 4 << 20  # SO_SNDBUF in bytes
+    rcvbuf: int = 4 << 20  # SO_RCVBUF in bytes
     proxy: Optional[ProxyConfig] = None
 
 def parse_server_args():
@@ -27,14 +40,26 @@ def parse_server_args():
     parser.add_argument('--protocol', choices=['tcp', 'udp'], default='udp', help='Protocol to use (default: udp)')
     parser.add_argument('--size', type=int, default=1024, help='Maximum message size in bytes')
     parser.add_argument('--timeout', type=float, default=1.0, help='Socket timeout in seconds')
+    parser.add_argument('--workers', type=int, default=1, help='Number of server processes sharing the port (default: 1)')
+    parser.add_argument('--sndbuf', type=int, default=4 << 20, help='Socket send buffer size in bytes (default: 4 MiB)')
+    parser.add_argument('--rcvbuf', type=int, default=8 << 20, help='Socket receive buffer size in bytes (default: 8 MiB)')
     
     args = parser.parse_args()
+    
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        parser.error("--workers requires os.fork and SO_REUSEPORT support")
+    
     return TestConfig(
         host=args.host,
         port=args.port,
         protocol=args.protocol,
         message_size=args.size,
-        timeout=args.timeout
+        timeout=args.timeout,
+        workers=args.workers,
+        sndbuf=args.sndbuf,
+        rcvbuf=args.rcvbuf
     )
 
 def parse_client_args():
@@ -46,6 +71,9 @@ def parse_client_args():
     parser.add_argument('--runtime', type=float, help='Test duration in seconds')
     parser.add_argument('--size', type=int, default=1024, help='Message size in bytes')
     parser.add_argument('--timeout', type=float, default=1.0, help='Socket timeout in seconds')
+    parser.add_argument('--rate', type=float, help='Maximum packets per second (default: unlimited)')
+    parser.add_argument('--sndbuf', type=int, default=4 << 20, help='Socket send buffer size in bytes (default: 4 MiB)')
+    parser.add_argument('--rcvbuf', type=int, default=4 << 20, help='Socket receive buffer size in bytes (default: 4 MiB)')
     
     # Proxy configuration
     proxy_group = parser.add_argument_group('SOCKS5 Proxy Configuration')
@@ -53,12 +81,16 @@ def parse_client_args():
     proxy_group.add_argument('--proxy-port', type=int, help='SOCKS5 proxy port')
     proxy_group.add_argument('--proxy-username', help='SOCKS5 proxy username (if authentication required)')
     proxy_group.add_argument('--proxy-password', help='SOCKS5 proxy password (if authentication required)')
+    proxy_group.add_argument('--verify-proxy', action='store_true', help='Verify the proxy with a separate SOCKS5 handshake before the test')
     
     args = parser.parse_args()
     
     if not args.messages and not args.runtime:
         parser.error("Either --messages or --runtime must be specified")
     
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be greater than 0")
+    
     # Configure proxy if proxy host is provided
     proxy_config = None
     if args.proxy_host:
@@ -68,7 +100,8 @@ def parse_client_args():
             host=args.proxy_host,
             port=args.proxy_port,
             username=args.proxy_username,
-            password=args.proxy_password
+            password=args.proxy_password,
+            verify=args.verify_proxy
         )
     
     test_config = TestConfig(
@@ -78,7 +111,10 @@ def parse_client_args():
         num_messages=args.messages,
         runtime=args.runtime,
         message_size=args.size,
-        timeout=args.timeout
+        timeout=args.timeout,
+        rate=args.rate,
+        sndbuf=args.sndbuf,
+        rcvbuf=args.rcvbuf
     )
     
     return test_config, proxy_config 
\ No newline at end of file
@@ -0,0 +1,125 @@
+# cython: language_level=3
+"""Compiled UDP echo loop for server.py (Linux only)
+
+Build in place with: python setup.py build_ext --inplace
+"""
+import os
+
+from libc.errno cimport errno, EAGAIN, EINTR, ENOMEM
+from libc.stdlib cimport malloc, free
+from libc.stdint cimport uint64_t, uintptr_t
+from libc.string cimport memset
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+from posix.uio cimport iovec
+
+cdef extern from "<sys/socket.h>" nogil:
+    ctypedef unsigned int socklen_t
+
+    struct sockaddr_storage:
+        pass
+
+    struct msghdr:
+        void *msg_name
+        socklen_t msg_namelen
+        iovec *msg_iov
+        size_t msg_iovlen
+        void *msg_control
+        size_t msg_controllen
+        int msg_flags
+
+    struct mmsghdr:
+        msghdr msg_hdr
+        unsigned int msg_len
+
+    int recvmmsg(int sockfd, mmsghdr *msgvec, unsigned int vlen, int flags, void *timeout)
+    int sendmmsg(int sockfd, mmsghdr *msgvec, unsigned int vlen, int flags)
+
+    enum:
+        MSG_WAITFORONE
+
+# Number of datagrams moved per recvmmsg/sendmmsg call, same as mmsg.BATCH_SIZE
+cdef enum:
+    BATCH_SIZE = 64
+
+cdef inline long long _monotonic_ns() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec * 1000000000LL + ts.tv_nsec
+
+cdef int _echo_loop(int fd, int msgsize, long long deadline_ns, uint64_t *received) noexcept nogil:
+    """Echo batches until the receive timeout expires or deadline_ns passes; returns 0 or an errno value"""
+    cdef size_t buf_size = msgsize + 8
+    cdef char *bufs = <char *>malloc(buf_size * BATCH_SIZE)
+    cdef sockaddr_storage addrs[BATCH_SIZE]
+    cdef iovec rx_iov[BATCH_SIZE]
+    cdef iovec tx_iov[BATCH_SIZE]
+    cdef mmsghdr rx_msgs[BATCH_SIZE]
+    cdef mmsghdr tx_msgs[BATCH_SIZE]
+    cdef int i, n, acks, sent
+    cdef int err = 0
+
+    if bufs == NULL:
+        return ENOMEM
+
+    memset(rx_msgs, 0, sizeof(rx_msgs))
+    memset(tx_msgs, 0, sizeof(tx_msgs))
+    for i in range(BATCH_SIZE):
+        rx_iov[i].iov_base = bufs + i * buf_size
+        rx_iov[i].iov_len = buf_size
+        rx_msgs[i].msg_hdr.msg_name = &addrs[i]
+        rx_msgs[i].msg_hdr.msg_iov = &rx_iov[i]
+        rx_msgs[i].msg_hdr.msg_iovlen = 1
+        tx_iov[i].iov_len = 8
+        tx_msgs[i].msg_hdr.msg_iov = &tx_iov[i]
+        tx_msgs[i].msg_hdr.msg_iovlen = 1
+
+    while True:
+        for i in range(BATCH_SIZE):
+            rx_msgs[i].msg_hdr.msg_namelen = sizeof(sockaddr_storage)
+
+        n = recvmmsg(fd, rx_msgs, BATCH_SIZE, MSG_WAITFORONE, NULL)
+        if n < 0:
+            # A receive timeout (EAGAIN, same as EWOULDBLOCK on Linux) or signal hands control back to Python
+            if errno != EAGAIN and errno != EINTR:
+                err = errno
+            break
+
+        # The ack is the 8-byte sequence prefix of each datagram, sent back to its source
+        acks = 0
+        for i in range(n):
+            if rx_msgs[i].msg_len >= 8:
+                tx_iov[acks].iov_base = rx_iov[i].iov_base
+                tx_msgs[acks].msg_hdr.msg_name = rx_msgs[i].msg_hdr.msg_name
+                tx_msgs[acks].msg_hdr.msg_namelen = rx_msgs[i].msg_hdr.msg_namelen
+                acks += 1
+
+        sent = 0
+        while sent < acks:
+            i = sendmmsg(fd, tx_msgs + sent, acks - sent, 0)
+            if i < 0:
+                if errno == EINTR:
+                    continue
+                err = errno
+                break
+            sent += i
+
+        # Count every batch straight away, so the total stays current while this loop runs
+        received[0] += n
+        if err or _monotonic_ns() >= deadline_ns:
+            break
+
+    free(bufs)
+    return err
+
+def echo_loop(int fd, int msgsize, uintptr_t counter_address, long long deadline_ns):
+    """Echo datagrams on a blocking UDP socket with the GIL released
+
+    Adds each batch's datagram count to the uint64 at counter_address (a StripedCounter
+    slot) and returns once the socket's receive timeout expires or time.monotonic_ns()
+    reaches deadline_ns.
+    """
+    cdef int err
+    with nogil:
+        err = _echo_loop(fd, msgsize, deadline_ns, <uint64_t *>counter_address)
+    if err:
+        raise OSError(err, os.strerror(err))
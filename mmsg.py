@@ -0,0 +1,67 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+
+# Number of datagrams moved per sendmmsg/recvmmsg call
+BATCH_SIZE = 64
+
+# recvmmsg flag: block for the first datagram only, then drain what is queued
+MSG_WAITFORONE = 0x10000
+
+class IOVec(ctypes.Structure):
+    """struct iovec from <sys/uio.h>"""
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+class SockAddrIn(ctypes.Structure):
+    """struct sockaddr_in from <netinet/in.h> (port and address in network byte order)"""
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_uint32),
+        ("sin_zero", ctypes.c_char * 8),
+    ]
+
+class MsgHdr(ctypes.Structure):
+    """struct msghdr from <sys/socket.h>"""
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.c_void_p),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class MMsgHdr(ctypes.Structure):
+    """struct mmsghdr from <sys/socket.h>"""
+    _fields_ = [
+        ("msg_hdr", MsgHdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+sendmmsg = None
+recvmmsg = None
+
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        sendmmsg = _libc.sendmmsg
+        sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        sendmmsg.restype = ctypes.c_int
+        recvmmsg = _libc.recvmmsg
+        recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        recvmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        sendmmsg = recvmmsg = None
+
+available = sendmmsg is not None and recvmmsg is not None
+
+def last_error() -> OSError:
+    """Build an OSError from the errno left behind by the last libc call"""
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
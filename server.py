@@ -1,19 +1,166 @@
+import asyncio
+import ctypes
+import errno
+import multiprocessing
+import os
 import socket
+import struct
 import time
-import select
-import threading
-from config import TestConfig, parse_server_args
+from typing import Optional
+from config import TCP_HELLO, TCP_HELLO_MAGIC, TestConfig, parse_server_args
+import mmsg
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None  # Fall back to the default asyncio event loop
+
+try:
+    import echo_core
+except ImportError:
+    echo_core = None  # Compiled echo loop not built, use the ctypes batch path
+
+class StripedCounter:
+    """Counter with one slot per worker process
+
+    Each worker only adds to its own slot, so no lock is needed and readers sum the slots.
+    The slots live in shared memory, so the counter must be created before workers fork.
+    """
+
+    def __init__(self, stripes: int):
+        self.slots = multiprocessing.RawArray(ctypes.c_uint64, stripes)
+
+    def add(self, stripe: int, count: int = 1):
+        self.slots[stripe] += count
+
+    def total(self) -> int:
+        return sum(self.slots)
+
+    def slot_address(self, stripe: int) -> int:
+        """Address of a slot, for compiled code that adds to it directly"""
+        return ctypes.addressof(self.slots) + stripe * ctypes.sizeof(ctypes.c_uint64)
+
+TCP_READ_SIZE = 65536  # Read whatever the kernel has coalesced, up to this many bytes
+
+class TcpEcho(asyncio.BufferedProtocol):
+    """Acknowledge each TCP packet by echoing its 8-byte sequence number
+
+    Packets are framed by the size the client announces when it connects. The transport
+    then receives straight into a preallocated buffer, which carries at most one partial
+    packet over from the previous read.
+    """
+
+    def __init__(self, server: "PacketServer"):
+        self.server = server
+        self.transport = None
+        self.addr = None
+        self.packet_size = None  # Known once the client's TCP_HELLO has arrived
+        self.buf = bytearray(TCP_READ_SIZE)
+        self.view = memoryview(self.buf)
+        self.filled = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        print(f"New TCP client connected: {self.addr}")
+        # Send acks as soon as they are written instead of waiting on Nagle's algorithm
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.clients.add(transport)
+        self.server.total_clients += 1
+
+    def connection_lost(self, exc):
+        self.server.clients.discard(self.transport)
+        if exc is not None:
+            print(f"Error handling TCP client {self.addr}: {exc}")
+
+    def pause_writing(self):
+        # The client is not reading its acks, stop reading its packets until it catches up
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def get_buffer(self, sizehint):
+        return self.view[self.filled:]
+
+    def read_hello(self, filled):
+        """Size the buffer for the client's announced message size, returning the packet size"""
+        magic, message_size = TCP_HELLO.unpack_from(self.buf)
+        if magic != TCP_HELLO_MAGIC:
+            print(f"Rejecting TCP client {self.addr}: no protocol hello, the client is probably too old")
+            self.transport.close()
+            return None
+        if message_size > self.server.config.message_size:
+            print(f"Rejecting TCP client {self.addr}: message size {message_size} exceeds the server's --size {self.server.config.message_size}")
+            self.transport.close()
+            return None
+        
+        self.packet_size = message_size + 8
+        buf = bytearray(self.packet_size + TCP_READ_SIZE)
+        buf[:filled - TCP_HELLO.size] = self.view[TCP_HELLO.size:filled]
+        self.buf = buf
+        self.view = memoryview(buf)
+        return self.packet_size
+
+    def buffer_updated(self, nbytes):
+        filled = self.filled + nbytes
+        packet_size = self.packet_size
+        if packet_size is None:
+            if filled < TCP_HELLO.size:
+                self.filled = filled
+                return
+            packet_size = self.read_hello(filled)
+            if packet_size is None:
+                return
+            filled -= TCP_HELLO.size
+        complete = filled - filled % packet_size
+        if not complete:
+            self.filled = filled
+            return
+        
+        # Acknowledge every complete packet in the buffer with one segment,
+        # each ack being the packet's sequence number (first 8 bytes)
+        view = self.view
+        ack_out = bytearray()
+        for offset in range(0, complete, packet_size):
+            ack_out += view[offset:offset + 8]
+        self.transport.write(ack_out)
+        self.server.received_packets.add(self.server.worker_id, complete // packet_size)
+        
+        # Move the trailing partial packet to the front for the next read
+        filled -= complete
+        self.buf[:filled] = view[complete:complete + filled]
+        self.filled = filled
+
+class UdpEcho(asyncio.DatagramProtocol):
+    """Acknowledge each UDP datagram by echoing its 8-byte sequence number"""
+
+    def __init__(self, server: "PacketServer"):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        self.transport.sendto(data[:8], addr)
+        self.server.received_packets.add(self.server.worker_id)
 
 class PacketServer:
-    def __init__(self, config: TestConfig):
+    def __init__(self, config: TestConfig, worker_id: int = 0, received_packets: Optional[StripedCounter] = None):
         self.config = config
+        self.worker_id = worker_id  # Also this worker's slot in the shared counters
+        self._rx_msgs = None  # recvmmsg message vector, set up for UDP on Linux without echo_core
+        self._run = None  # Serving loop for the protocol, chosen in setup_socket
         self.setup_socket()
         self.running = False
-        self.received_packets = 0
-        self.start_time = None
-        self.last_stats_time = None
+        self.received_packets = received_packets or StripedCounter(config.workers)
+        self.start_ns = None  # time.monotonic_ns() at server start
         self.stats_interval = 5.0  # Print stats every 5 seconds
-        self.clients = set()  # For TCP connections
+        self.clients = set()  # Transports of the connected TCP clients
+        self.total_clients = 0
 
     def setup_socket(self):
         if self.config.protocol == "tcp":
@@ -21,103 +168,174 @@ class PacketServer:
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         else:  # UDP
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.config.workers > 1:
+            # Every worker binds its own socket; the kernel spreads flows across them
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Set before listen() so accepted TCP sockets inherit the sizes
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.config.sndbuf)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.config.rcvbuf)
         
         self.sock.bind((self.config.host, self.config.port))
         if self.config.protocol == "tcp":
             self.sock.listen(5)
             self.sock.setblocking(False)
+            self._run = self._run_tcp
+        elif mmsg.available:
+            # Block in recvmmsg, but wake up periodically to print stats and check for shutdown
+            self.sock.setblocking(True)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', 0, 100000))
+            if echo_core is not None:
+                self._run = self._run_udp_echo_core
+            else:
+                self.setup_batch()
+                self._run = self._run_udp_batch
         else:
             self.sock.setblocking(False)
+            self._run = self._run_udp
 
-    def handle_tcp_client(self, client_sock, addr):
-        """Handle individual TCP client connection"""
+    def setup_batch(self):
+        """Preallocate the recvmmsg/sendmmsg message vectors used for batched UDP echo"""
+        batch = mmsg.BATCH_SIZE
+        buf_size = self.config.message_size + 8
+        self._rx_bufs = (ctypes.c_char * (buf_size * batch))()
+        self._rx_addrs = (mmsg.SockAddrIn * batch)()
+        self._rx_iov = (mmsg.IOVec * batch)()
+        self._rx_msgs = (mmsg.MMsgHdr * batch)()
+        self._tx_iov = (mmsg.IOVec * batch)()
+        self._tx_msgs = (mmsg.MMsgHdr * batch)()
+
+        bufs_base = ctypes.addressof(self._rx_bufs)
+        addrs_base = ctypes.addressof(self._rx_addrs)
+        rx_iov_base = ctypes.addressof(self._rx_iov)
+        tx_iov_base = ctypes.addressof(self._tx_iov)
+        addr_size = ctypes.sizeof(mmsg.SockAddrIn)
+        iov_size = ctypes.sizeof(mmsg.IOVec)
+        for i in range(batch):
+            self._rx_iov[i].iov_base = bufs_base + i * buf_size
+            self._rx_iov[i].iov_len = buf_size
+            hdr = self._rx_msgs[i].msg_hdr
+            hdr.msg_name = addrs_base + i * addr_size
+            hdr.msg_namelen = addr_size
+            hdr.msg_iov = rx_iov_base + i * iov_size
+            hdr.msg_iovlen = 1
+
+            self._tx_iov[i].iov_len = 8
+            hdr = self._tx_msgs[i].msg_hdr
+            hdr.msg_namelen = addr_size
+            hdr.msg_iov = tx_iov_base + i * iov_size
+            hdr.msg_iovlen = 1
+
+    def echo_batch(self):
+        """Receive a batch of datagrams with recvmmsg and acknowledge them with one sendmmsg"""
+        fd = self.sock.fileno()
+        received = mmsg.recvmmsg(fd, self._rx_msgs, mmsg.BATCH_SIZE, mmsg.MSG_WAITFORONE, None)
+        if received < 0:
+            err = mmsg.last_error()
+            if err.errno not in (socket.EAGAIN, socket.EWOULDBLOCK, errno.EINTR):
+                raise err
+            return
+
+        # The ack is the 8-byte sequence prefix of each datagram, sent back to its source
+        acks = 0
+        addr_size = ctypes.sizeof(mmsg.SockAddrIn)
+        rx_msgs, rx_iov = self._rx_msgs, self._rx_iov
+        tx_msgs, tx_iov = self._tx_msgs, self._tx_iov
+        for i in range(received):
+            rx = rx_msgs[i]
+            if rx.msg_len >= 8:
+                tx_iov[acks].iov_base = rx_iov[i].iov_base
+                tx_msgs[acks].msg_hdr.msg_name = rx.msg_hdr.msg_name
+                acks += 1
+            rx.msg_hdr.msg_namelen = addr_size
+
+        sent = 0
+        msg_size = ctypes.sizeof(mmsg.MMsgHdr)
+        while sent < acks:
+            n = mmsg.sendmmsg(fd, ctypes.addressof(tx_msgs) + sent * msg_size, acks - sent, 0)
+            if n < 0:
+                err = mmsg.last_error()
+                if err.errno != errno.EINTR:
+                    raise err
+                continue
+            sent += n
+        self.received_packets.add(self.worker_id, received)
+
+    def _run_tcp(self):
+        """Serve TCP clients on the event loop"""
+        asyncio.run(self.serve_tcp())
+
+    def _run_udp(self):
+        """Serve UDP datagrams one at a time on the event loop"""
+        asyncio.run(self.serve_udp())
+
+    async def serve_tcp(self):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: TcpEcho(self), sock=self.sock)
         try:
-            while self.running:
-                try:
-                    data = client_sock.recv(self.config.message_size + 8)
-                    if not data:
-                        break
-                    
-                    # Extract sequence number (first 8 bytes) and payload
-                    seq_num = int.from_bytes(data[:8], byteorder='big')
-                    payload = data[8:]
-                    
-                    # Send acknowledgment with sequence number
-                    ack = seq_num.to_bytes(8, byteorder='big')
-                    client_sock.send(ack)
-                    self.received_packets += 1
-                    
-                except socket.error as e:
-                    if e.errno not in (socket.EAGAIN, socket.EWOULDBLOCK):
-                        break
-                    time.sleep(0.001)
-        except Exception as e:
-            print(f"Error handling TCP client {addr}: {e}")
+            await self.report_stats()
         finally:
-            client_sock.close()
-            self.clients.remove(client_sock)
+            server.close()
+            for transport in list(self.clients):
+                transport.close()
+
+    async def serve_udp(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: UdpEcho(self), sock=self.sock)
+        try:
+            await self.report_stats()
+        finally:
+            transport.close()
+
+    async def report_stats(self):
+        """Print periodic statistics while the protocol callbacks do the echoing"""
+        while self.running:
+            await asyncio.sleep(self.stats_interval)
+            self.print_current_stats()
+
+    def _run_udp_echo_core(self):
+        """Serve UDP datagrams with the compiled echo loop"""
+        fd = self.sock.fileno()
+        message_size = self.config.message_size
+        counter_address = self.received_packets.slot_address(self.worker_id)
+        stats_interval_ns = int(self.stats_interval * 1e9)
+        stats_deadline_ns = self.start_ns + stats_interval_ns
+        while self.running:
+            # Runs batches in C with the GIL released, counting each one into this worker's slot,
+            # and returns on the receive timeout or when the next stats are due
+            echo_core.echo_loop(fd, message_size, counter_address, stats_deadline_ns)
+            
+            # Print periodic statistics
+            now_ns = time.monotonic_ns()
+            if now_ns >= stats_deadline_ns:
+                self.print_current_stats()
+                stats_deadline_ns = now_ns + stats_interval_ns
+
+    def _run_udp_batch(self):
+        """Serve UDP datagrams in recvmmsg batches"""
+        echo_batch = self.echo_batch
+        stats_interval_ns = int(self.stats_interval * 1e9)
+        stats_deadline_ns = self.start_ns + stats_interval_ns
+        while self.running:
+            echo_batch()
+            
+            # Print periodic statistics
+            now_ns = time.monotonic_ns()
+            if now_ns >= stats_deadline_ns:
+                self.print_current_stats()
+                stats_deadline_ns = now_ns + stats_interval_ns
 
     def start(self):
         self.running = True
-        self.start_time = time.time()
-        self.last_stats_time = self.start_time
+        self.start_ns = time.monotonic_ns()
         print(f"Server listening on {self.config.host}:{self.config.port} using {self.config.protocol.upper()}")
         print("Press Ctrl+C to stop the server")
         
-        while self.running:
-            try:
-                if self.config.protocol == "tcp":
-                    # Handle TCP connections
-                    readable, _, _ = select.select([self.sock], [], [], 0.1)
-                    if self.sock in readable:
-                        try:
-                            client_sock, addr = self.sock.accept()
-                            client_sock.setblocking(False)
-                            self.clients.add(client_sock)
-                            client_thread = threading.Thread(
-                                target=self.handle_tcp_client,
-                                args=(client_sock, addr)
-                            )
-                            client_thread.daemon = True
-                            client_thread.start()
-                            print(f"New TCP client connected: {addr}")
-                        except socket.error as e:
-                            if e.errno not in (socket.EAGAIN, socket.EWOULDBLOCK):
-                                raise
-                else:
-                    # Handle UDP packets
-                    readable, _, _ = select.select([self.sock], [], [], 0.1)
-                    if self.sock in readable:
-                        try:
-                            data, addr = self.sock.recvfrom(self.config.message_size + 8)
-                            if not data:
-                                continue
-                            
-                            # Extract sequence number (first 8 bytes) and payload
-                            seq_num = int.from_bytes(data[:8], byteorder='big')
-                            payload = data[8:]
-                            
-                            # Send acknowledgment with sequence number
-                            ack = seq_num.to_bytes(8, byteorder='big')
-                            self.sock.sendto(ack, addr)
-                            self.received_packets += 1
-                            
-                        except socket.error as e:
-                            if e.errno not in (socket.EAGAIN, socket.EWOULDBLOCK):
-                                raise
-                
-                # Print periodic statistics
-                current_time = time.time()
-                if current_time - self.last_stats_time >= self.stats_interval:
-                    self.print_current_stats()
-                    self.last_stats_time = current_time
-                
-            except KeyboardInterrupt:
-                print("\nShutdown signal received, stopping server...")
-                break
-            except Exception as e:
-                print(f"Server error: {e}")
-                break
+        try:
+            self._run()
+        except KeyboardInterrupt:
+            print("\nShutdown signal received, stopping server...")
+        except Exception as e:
+            print(f"Server error: {e}")
         
         self.cleanup()
 
@@ -128,52 +346,72 @@ class PacketServer:
     def cleanup(self):
         """Clean up resources"""
         try:
-            if self.config.protocol == "tcp":
-                # Close all client connections
-                for client in self.clients:
-                    try:
-                        client.close()
-                    except:
-                        pass
-                self.clients.clear()
             self.sock.close()
         except Exception as e:
             print(f"Error during cleanup: {e}")
         self.print_final_stats()
 
     def print_current_stats(self):
-        if not self.start_time:
+        if self.start_ns is None:
             return
             
-        duration = time.time() - self.start_time
-        packets_per_second = self.received_packets / duration if duration > 0 else 0
+        duration = (time.monotonic_ns() - self.start_ns) / 1e9
+        received = self.received_packets.total()
+        packets_per_second = received / duration if duration > 0 else 0
         
         print(f"\nCurrent Server Statistics:")
+        if self.config.workers > 1:
+            print(f"Worker: {self.worker_id + 1}/{self.config.workers}")
         print(f"Protocol: {self.config.protocol.upper()}")
         if self.config.protocol == "tcp":
             print(f"Active clients: {len(self.clients)}")
-        print(f"Total packets received: {self.received_packets}")
+        if self.config.workers > 1:
+            print(f"Packets received by this worker: {self.received_packets.slots[self.worker_id]}")
+        print(f"Total packets received: {received}")
         print(f"Running time: {duration:.1f} seconds")
         print(f"Average packets per second: {packets_per_second:.1f}")
 
     def print_final_stats(self):
-        if not self.start_time:
+        if self.start_ns is None:
             return
             
-        duration = time.time() - self.start_time
-        packets_per_second = self.received_packets / duration if duration > 0 else 0
+        duration = (time.monotonic_ns() - self.start_ns) / 1e9
+        received = self.received_packets.total()
+        packets_per_second = received / duration if duration > 0 else 0
         
         print(f"\nFinal Server Statistics:")
+        if self.config.workers > 1:
+            print(f"Worker: {self.worker_id + 1}/{self.config.workers}")
         print(f"Protocol: {self.config.protocol.upper()}")
         if self.config.protocol == "tcp":
-            print(f"Total clients handled: {len(self.clients)}")
-        print(f"Total packets received: {self.received_packets}")
+            print(f"Total clients handled: {self.total_clients}")
+        if self.config.workers > 1:
+            print(f"Packets received by this worker: {self.received_packets.slots[self.worker_id]}")
+        print(f"Total packets received: {received}")
         print(f"Total running time: {duration:.1f} seconds")
         print(f"Average packets per second: {packets_per_second:.1f}")
 
 def main():
     config = parse_server_args()
-    server = PacketServer(config)
+    
+    # Shared by all workers, so it has to exist before they are forked
+    received_packets = StripedCounter(config.workers)
+    
+    # Fork the extra workers before binding so each one gets its own SO_REUSEPORT socket
+    worker_id = 0
+    children = []
+    for i in range(1, config.workers):
+        pid = os.fork()
+        if pid == 0:
+            worker_id = i
+            children = []
+            break
+        children.append(pid)
+    
+    server = PacketServer(config, worker_id, received_packets)
+    
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     
     try:
         server.start()
@@ -182,6 +420,8 @@ def main():
     finally:
         server.stop()
         server.cleanup()
+        for pid in children:
+            os.waitpid(pid, 0)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,9 @@
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+# Builds the optional compiled UDP echo loop used by server.py:
+#   python setup.py build_ext --inplace
+setup(
+    name="echo_core",
+    ext_modules=cythonize([Extension("echo_core", ["echo_core.pyx"])]),
+)